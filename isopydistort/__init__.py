@@ -17,5 +17,6 @@
 """
 
 import isopydistort.isoget
+import isopydistort.modestore
 
 # End of file
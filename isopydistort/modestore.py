@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# isopydistort         by Frandsen Group
+#                     Benjamin A. Frandsen benfrandsen@byu.edu
+#                     (c) 2023 Benjamin Allen Frandsen
+#                      All rights reserved
+#
+# See AUTHORS.txt for a list of people who contributed.
+# See LICENSE.txt for license information.
+#
+##############################################################################
+
+"""Compact on-disk store for mode definitions downloaded with isoget.get().
+
+The store is a directory of append-only binary columns, one row per mode,
+plus a small JSON index mapping each (parent CIF, subgroup, basis) key to
+the block of rows it owns. Columns are read back with numpy.memmap, so
+slicing the modes of one distortion does not copy or re-parse anything.
+"""
+
+import os
+import re
+import json
+import time
+import functools
+import contextlib
+import concurrent.futures
+from fractions import Fraction
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'ingest.lock'
+FLOAT_COLUMNS = ['amplitude', 'minimum', 'maximum', 'normfactor']
+STRING_COLUMNS = ['name', 'label', 'section']
+
+# Regex expression for a topas mode definition, e.g.
+# prm  !a1  0.00000 min -2.00 max 2.00 'P-3m1[0,0,0]GM1+(a)[Ti1:a:dsp]A1g(a) normfactor:  0.1021
+_MODE_PATTERN = re.compile(r"^prm\s+!?(?P<name>\S+)\s+(?P<amplitude>\S+)"
+                           r"(?:\s+min\s+(?P<minimum>\S+))?"
+                           r"(?:\s+max\s+(?P<maximum>\S+))?"
+                           r"\s*(?:'(?P<label>.*))?$")
+_NORM_PATTERN = re.compile(r'\s*normfactor:\s*(\S+)\s*$')
+# Column file names, e.g. amplitude_3.f8
+_COLUMN_PATTERN = re.compile(r'^[a-z]+_(\d+)\.(?:f8|bin|off)$')
+
+
+def _toFloat(val):
+    """Convert a number from the topas file, returning nan if it is absent.
+    """
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def _basisKey(basis):
+    """Turn a supercell basis into an index key.
+
+    The basis may be given as in get(): a var_dict with the keys 'basis11'
+    to 'basis33' (missing keys default to the identity), or a nested or
+    flat list of 9 numbers or strings such as '1/2'.
+    """
+    if isinstance(basis, dict):
+        values = [basis.get(f'basis{i}{j}', '1' if i == j else '0')
+                  for i in range(1, 4) for j in range(1, 4)]
+    else:
+        values = np.asarray(basis, dtype=object).ravel()
+    if len(values) != 9:
+        raise ValueError("Incorrect number of elements for basis, expected 9")
+    # Fraction gives one spelling for 0.5, '1/2' and '0.50', and for -0.0 and 0
+    return ','.join(str(Fraction(str(v).strip()).limit_denominator(1000))
+                    for v in values)
+
+
+def parseModes(fname):
+    """Read the mode definitions from a topas file written by get().
+
+    Every section whose header contains 'mode definitions' is read, e.g.
+    the displacive modes and, if 'topasstrain' was requested, the strain
+    modes. The header of each section is kept in the 'section' column.
+
+    Args:
+        fname (str): The name of the ISODISTORT topas output file.
+
+    Returns:
+        dict: One list per column in FLOAT_COLUMNS and STRING_COLUMNS, with
+            one element per mode in the order they appear in the file.
+    """
+    modes = {col: [] for col in FLOAT_COLUMNS + STRING_COLUMNS}
+    f = open(fname, 'r')
+    lines = f.readlines()
+    f.close()
+
+    section = None
+    count = 0  # number of modes read from the current section
+    for line in lines:
+        line = line.strip()
+        if 'mode definitions' in line:
+            section = line.strip("'! ")
+            count = 0
+            continue
+        if section is None:
+            continue
+        if not line.startswith('prm'):
+            if count:
+                section = None
+            continue
+        match = _MODE_PATTERN.match(line)
+        if match is None:
+            continue
+        label = match.group('label') or ''
+        norm = _NORM_PATTERN.search(label)
+        if norm:
+            label = label[:norm.start()]
+        modes['name'].append(match.group('name'))
+        modes['label'].append(label.strip())
+        modes['section'].append(section)
+        modes['amplitude'].append(_toFloat(match.group('amplitude')))
+        modes['minimum'].append(_toFloat(match.group('minimum')))
+        modes['maximum'].append(_toFloat(match.group('maximum')))
+        modes['normfactor'].append(_toFloat(norm.group(1) if norm else None))
+        count += 1
+
+    if not modes['name']:
+        raise ValueError(f"No mode definitions found in {fname}")
+    return modes
+
+
+def _parseFile(fname):
+    """Stat and parse one file; run in the worker processes of ingest().
+    """
+    stat = os.stat(fname)
+    return stat.st_mtime, stat.st_size, parseModes(fname)
+
+
+def _retry(method):
+    """Reload the index and try once more if compact() in another process
+    has removed the column files this instance was reading.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except FileNotFoundError:
+            self.reload()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class ModeStore:
+    """Append-only columnar store of mode definitions.
+
+    Each float column is a raw float64 file. Each string column is a UTF-8
+    byte blob together with an int64 file of end offsets into it. The index
+    records the number of valid rows, so an interrupted ingest never
+    exposes partially written data; the leftover bytes are truncated by
+    the next ingest.
+
+    Entries are keyed by the path of the parent CIF, the subgroup and the
+    basis. Paths are resolved against root if it is given, and stored
+    relative to it, so the same sweep can be opened from any working
+    directory or after it has been moved. Without root, paths are stored
+    as resolved from the current working directory. Lookups with modes()
+    and entries() must name the parent CIF the same way it was ingested.
+
+    Re-ingesting a key from a changed file appends new rows and leaves the
+    old block in place, unreferenced. Call compact() after re-running a
+    sweep to rewrite the columns with only the live blocks. compact()
+    keeps the previous generation of column files until the next compact,
+    so other instances can keep reading; they pick up the new generation
+    with reload(), or by themselves if their files have been removed.
+
+    Writers take an OS lock on a file in the store directory, so several
+    processes may ingest into the same store. The lock is released if the
+    process holding it dies.
+
+    Args:
+        path (str): Directory holding the store. Created if it does not
+            exist.
+        root (str): Directory that parent CIF and topas paths are taken
+            relative to. A relative root is taken relative to path.
+    """
+
+    def __init__(self, path, root=None):
+        self.path = path
+        if root is not None:
+            root = os.path.realpath(os.path.join(path, root))
+        self.root = root
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.reload()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _columnFile(self, col, ext, generation=None):
+        if generation is None:
+            generation = self._index['generation']
+        return f'{col}_{generation}.{ext}'
+
+    def _resolve(self, fname):
+        """Path of fname as stored in the index.
+        """
+        if self.root is None:
+            return os.path.realpath(fname)
+        fname = os.path.realpath(os.path.join(self.root, fname))
+        return os.path.relpath(fname, self.root)
+
+    def _absolute(self, fname):
+        """Path on disk of a path stored in the index.
+        """
+        if self.root is None:
+            return fname
+        return os.path.join(self.root, fname)
+
+    def reload(self):
+        """Re-read the index, picking up ingests and compacts made by other
+        instances. Row numbers from rows() refer to the index they were
+        taken from, so get them again after calling this.
+        """
+        fname = self._file(INDEX_FILE)
+        if os.path.exists(fname):
+            f = open(fname, 'r')
+            self._index = json.load(f)
+            f.close()
+        else:
+            self._index = {'generation': 0, 'nrows': 0, 'nbytes': {},
+                           'entries': {}}
+        self._maps = {}
+
+    def _saveIndex(self):
+        fname = self._file(INDEX_FILE)
+        f = open(fname + '.tmp', 'w')
+        json.dump(self._index, f, indent=1)
+        f.close()
+        os.replace(fname + '.tmp', fname)
+        self._maps = {}
+
+    @contextlib.contextmanager
+    def _lock(self, timeout=None):
+        """Hold the store's lock, waiting up to timeout seconds for it
+        (forever if timeout is None).
+        """
+        f = open(self._file(LOCK_FILE), 'a+')
+        start = time.time()
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if timeout is not None and time.time() - start > timeout:
+                    f.close()
+                    raise RuntimeError(f"Timed out after {timeout} s waiting "
+                                       f"for another process to release "
+                                       f"{self._file(LOCK_FILE)}")
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            f.close()
+
+    def _map(self, fname, dtype, count):
+        """Memory-map the first count elements of a column file.
+        """
+        key = (fname, count)
+        if key not in self._maps:
+            if count == 0:
+                self._maps[key] = np.zeros(0, dtype=dtype)
+            else:
+                self._maps[key] = np.memmap(self._file(fname), dtype=dtype,
+                                            mode='r', shape=(count,))
+        return self._maps[key]
+
+    def _append(self, fname, payload, valid):
+        """Append bytes to a column, dropping anything past the valid size.
+        """
+        f = open(self._file(fname), 'ab')
+        f.truncate(valid)
+        f.write(payload)
+        f.close()
+
+    def _needsIngest(self, key, source):
+        entry = self._index['entries'].get(key)
+        if entry is None:
+            return True
+        stat = os.stat(self._absolute(source))
+        return (entry['source'] != source or
+                entry['mtime'] != stat.st_mtime or
+                entry['size'] != stat.st_size)
+
+    def _write(self, blocks):
+        """Append blocks of modes to the columns and add them to the index.
+
+        Must be called with the lock held and a freshly loaded index.
+
+        Args:
+            blocks (dict): Index entries without 'start' and 'count', each
+                with the parsed modes under 'modes', keyed by key().
+        """
+        nbytes = self._index['nbytes']
+        start = nrows = self._index['nrows']
+        buffers = {col: [] for col in FLOAT_COLUMNS}
+        blobs = {col: [] for col in STRING_COLUMNS}
+        offsets = {col: [] for col in STRING_COLUMNS}
+        ends = {col: nbytes.get(col, 0) for col in STRING_COLUMNS}
+        entries = {}
+        for key, block in blocks.items():
+            modes = block.pop('modes')
+            count = len(modes['name'])
+            entries[key] = dict(block, start=nrows, count=count)
+            nrows += count
+            for col in FLOAT_COLUMNS:
+                buffers[col].extend(modes[col])
+            for col in STRING_COLUMNS:
+                for s in modes[col]:
+                    b = s.encode('utf-8')
+                    blobs[col].append(b)
+                    ends[col] += len(b)
+                    offsets[col].append(ends[col])
+
+        for col in FLOAT_COLUMNS:
+            self._append(self._columnFile(col, 'f8'),
+                         np.asarray(buffers[col], dtype='<f8').tobytes(),
+                         start * 8)
+        for col in STRING_COLUMNS:
+            self._append(self._columnFile(col, 'bin'), b''.join(blobs[col]),
+                         nbytes.get(col, 0))
+            self._append(self._columnFile(col, 'off'),
+                         np.asarray(offsets[col], dtype='<i8').tobytes(),
+                         start * 8)
+            nbytes[col] = ends[col]
+
+        self._index['nrows'] = nrows
+        self._index['entries'].update(entries)
+        self._saveIndex()
+
+    def ingest(self, items, processes=None, timeout=None):
+        """Add topas files to the store, skipping those already up to date.
+
+        Files are parsed in parallel by a process pool; the columns and
+        index are written by the calling process only, under the store's
+        lock. A file that cannot be read or holds no mode definitions (e.g.
+        an error page saved by get()) is reported and the rest of the batch
+        is still stored.
+
+        Args:
+            items (list): Tuples of (fname, parentcif, subgroup, basis),
+                where fname is a topas file written by get(), parentcif is
+                the parent CIF it was generated from, subgroup is the
+                'subgroupsym' value used, and basis is the supercell basis,
+                either the var_dict passed to get() or a nested or flat
+                list of 9 values. An item repeated with the same fname is
+                ingested once; the same key with two different fnames
+                raises ValueError.
+            processes (int): Number of worker processes. Defaults to the
+                number of CPUs.
+            timeout (float): Seconds to wait for another process writing to
+                the store. Waits as long as needed by default.
+
+        Returns:
+            tuple: The list of keys that were added or updated, and a dict
+                mapping the fname of each file that could not be ingested
+                to the reason why.
+        """
+        todo = {}
+        for fname, parentcif, subgroup, basis in items:
+            key = self.key(parentcif, subgroup, basis)
+            source = self._resolve(fname)
+            if key in todo:
+                if todo[key]['source'] != source:
+                    raise ValueError(f"Both {todo[key]['source']} and {source} "
+                                     f"were given for {key}")
+                continue
+            todo[key] = {'parentcif': self._resolve(parentcif),
+                         'subgroup': str(subgroup),
+                         'basis': _basisKey(basis),
+                         'source': source,
+                         'fname': fname}
+
+        self.reload()
+        failed = {}
+        for key in list(todo):
+            try:
+                if not self._needsIngest(key, todo[key]['source']):
+                    del todo[key]
+            except OSError as e:
+                failed[todo.pop(key)['fname']] = str(e)
+        if not todo:
+            return [], failed
+
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            futures = {key: pool.submit(_parseFile, self._absolute(entry['source']))
+                       for key, entry in todo.items()}
+            for key, future in futures.items():
+                entry = todo[key]
+                try:
+                    mtime, size, modes = future.result()
+                except (OSError, ValueError, UnicodeDecodeError) as e:
+                    failed[todo.pop(key)['fname']] = str(e)
+                    continue
+                del entry['fname']
+                entry.update(mtime=mtime, size=size, modes=modes)
+
+        with self._lock(timeout):
+            # another process may have written to the store since we looked
+            self.reload()
+            blocks = {}
+            for key, block in todo.items():
+                entry = self._index['entries'].get(key)
+                if (entry is not None and entry['source'] == block['source'] and
+                        entry['mtime'] == block['mtime'] and
+                        entry['size'] == block['size']):
+                    continue
+                blocks[key] = block
+            if blocks:
+                self._write(blocks)
+        return list(blocks), failed
+
+    def compact(self, timeout=None):
+        """Rewrite the columns keeping only rows referenced by the index.
+
+        The live blocks are copied to a new generation of column files and
+        the index is switched over to them. The generation being replaced
+        is kept for instances still reading it; older ones are removed.
+
+        Args:
+            timeout (float): Seconds to wait for another process writing to
+                the store. Waits as long as needed by default.
+
+        Returns:
+            int: The number of rows dropped.
+        """
+        with self._lock(timeout):
+            self.reload()
+            new = self._index['generation'] + 1
+            nrows = self._index['nrows']
+            entries = sorted(self._index['entries'].values(),
+                             key=lambda e: e['start'])
+
+            for col in FLOAT_COLUMNS:
+                data = self._column(col)
+                f = open(self._file(self._columnFile(col, 'f8', new)), 'wb')
+                for entry in entries:
+                    stop = entry['start'] + entry['count']
+                    f.write(np.asarray(data[entry['start']:stop], dtype='<f8').tobytes())
+                f.close()
+            nbytes = {}
+            for col in STRING_COLUMNS:
+                ends = self._map(self._columnFile(col, 'off'), '<i8', nrows)
+                blob = self._map(self._columnFile(col, 'bin'), 'u1',
+                                 self._index['nbytes'].get(col, 0))
+                fblob = open(self._file(self._columnFile(col, 'bin', new)), 'wb')
+                foff = open(self._file(self._columnFile(col, 'off', new)), 'wb')
+                total = 0
+                for entry in entries:
+                    stop = entry['start'] + entry['count']
+                    first = int(ends[entry['start'] - 1]) if entry['start'] > 0 else 0
+                    last = int(ends[stop - 1])
+                    fblob.write(np.asarray(blob[first:last]).tobytes())
+                    shifted = np.asarray(ends[entry['start']:stop], dtype='<i8') - first + total
+                    foff.write(shifted.tobytes())
+                    total += last - first
+                fblob.close()
+                foff.close()
+                nbytes[col] = total
+            # release the memory maps so the files can be removed on Windows
+            data = ends = blob = None
+
+            start = 0
+            for entry in entries:
+                entry['start'] = start
+                start += entry['count']
+            self._index['generation'] = new
+            self._index['nrows'] = start
+            self._index['nbytes'] = nbytes
+            self._saveIndex()
+            self._removeGenerations(new - 1)
+        return nrows - start
+
+    def _removeGenerations(self, keep):
+        """Remove column files older than generation keep.
+
+        Files still open elsewhere cannot be removed on Windows; they are
+        left for the next compact() to collect.
+        """
+        for name in os.listdir(self.path):
+            match = _COLUMN_PATTERN.match(name)
+            if match and int(match.group(1)) < keep:
+                try:
+                    os.remove(self._file(name))
+                except PermissionError:
+                    pass
+
+    def key(self, parentcif, subgroup, basis):
+        """Build the index key for a parent CIF, subgroup and basis.
+        """
+        return '|'.join([self._resolve(parentcif), str(subgroup),
+                         _basisKey(basis)])
+
+    def __len__(self):
+        return self._index['nrows']
+
+    def __contains__(self, key):
+        return key in self._index['entries']
+
+    def entries(self, parentcif=None, subgroup=None, basis=None):
+        """List index entries, optionally filtered by any part of the key.
+
+        parentcif is resolved the same way as in ingest(), so it must be
+        named relative to the same root or working directory.
+
+        Returns:
+            dict: Copies of the index entries keyed by key(). Each entry
+                gives 'start' and 'count', the block of rows holding its
+                modes.
+        """
+        if parentcif is not None:
+            parentcif = self._resolve(parentcif)
+        if basis is not None:
+            basis = _basisKey(basis)
+        out = {}
+        for key, entry in self._index['entries'].items():
+            if parentcif is not None and entry['parentcif'] != parentcif:
+                continue
+            if subgroup is not None and entry['subgroup'] != str(subgroup):
+                continue
+            if basis is not None and entry['basis'] != basis:
+                continue
+            out[key] = dict(entry)
+        return out
+
+    def _column(self, col):
+        if col not in FLOAT_COLUMNS:
+            raise ValueError(f"Unknown column {col}, expected one of {FLOAT_COLUMNS}")
+        return self._map(self._columnFile(col, 'f8'), '<f8', self._index['nrows'])
+
+    def _strings(self, col, start=0, stop=None):
+        if col not in STRING_COLUMNS:
+            raise ValueError(f"Unknown column {col}, expected one of {STRING_COLUMNS}")
+        nrows = self._index['nrows']
+        stop = nrows if stop is None else stop
+        ends = self._map(self._columnFile(col, 'off'), '<i8', nrows)
+        blob = self._map(self._columnFile(col, 'bin'), 'u1',
+                         self._index['nbytes'].get(col, 0))
+        first = int(ends[start - 1]) if start > 0 else 0
+        out = []
+        for end in ends[start:stop]:
+            out.append(bytes(blob[first:end]).decode('utf-8'))
+            first = int(end)
+        return out
+
+    @_retry
+    def column(self, col):
+        """Memory-mapped view of a float column over every stored row.
+
+        Args:
+            col (str): One of FLOAT_COLUMNS.
+        """
+        return self._column(col)
+
+    @_retry
+    def strings(self, col, start=0, stop=None):
+        """Decode rows start:stop of a string column.
+
+        Args:
+            col (str): One of STRING_COLUMNS.
+        """
+        return self._strings(col, start, stop)
+
+    @_retry
+    def modes(self, parentcif, subgroup, basis):
+        """Modes of a single distortion.
+
+        The float columns are zero-copy slices of the memory-mapped store.
+        parentcif is resolved the same way as in ingest(), so it must be
+        named relative to the same root or working directory.
+
+        Returns:
+            dict: Arrays for FLOAT_COLUMNS and lists for STRING_COLUMNS.
+        """
+        entry = self._index['entries'][self.key(parentcif, subgroup, basis)]
+        start, stop = entry['start'], entry['start'] + entry['count']
+        out = {col: self._column(col)[start:stop] for col in FLOAT_COLUMNS}
+        for col in STRING_COLUMNS:
+            out[col] = self._strings(col, start, stop)
+        return out
+
+    def rows(self, parentcif=None, subgroup=None, basis=None):
+        """Row numbers of every mode belonging to the matching entries.
+
+        Use these to index column() across many distortions at once.
+        """
+        blocks = [np.arange(e['start'], e['start'] + e['count'])
+                  for e in self.entries(parentcif, subgroup, basis).values()]
+        if not blocks:
+            return np.zeros(0, dtype=int)
+        return np.concatenate(blocks)
+
+# End of file
@@ -21,6 +21,7 @@ import unittest
 import isopydistort
 import sys
 import os
+import tempfile
 
 ##############################################################################
 def find(name, path):
@@ -47,6 +48,167 @@ class testBasic(unittest.TestCase):
 
 # End of class
 
+TOPAS_MODES = """'mode definitions
+prm  !a1   0.00000 min -2.00 max  2.00 'P-3m1[0,0,0]GM1+(a)[Ti1:a:dsp]A1g(a) normfactor:  0.10213
+prm  !a2   0.50000 min -2.00 max  2.00 'P-3m1[1/2,0,1/2]L1-(a;0;0)[Se1:d:dsp]A2u(a) normfactor:  0.04410
+
+'mode-amplitude to delta transformation
+prm !Ti1_1_dz = 0 + 0.10213 * a1;
+
+'strain mode definitions
+prm  !s1   0.00000 min -0.10 max  0.10 'P-3m1[0,0,0]GM1+(a)strain(a)
+"""
+
+class testModeStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.topas = [self.write(f"TiSe2_iso_{i}.txt", TOPAS_MODES) for i in range(2)]
+        self.basis = [[0, -2, 0], [2, 0, 0], [0, 0, 2]]
+        self.path = os.path.join(self.tmp.name, 'store')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        fname = os.path.join(self.tmp.name, name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        f = open(fname, 'w')
+        f.write(text)
+        f.close()
+        return fname
+
+    def test_parse(self):
+        modes = isopydistort.modestore.parseModes(self.topas[0])
+        self.assertEqual(modes['name'], ['a1', 'a2', 's1'])
+        self.assertEqual(modes['label'][1], 'P-3m1[1/2,0,1/2]L1-(a;0;0)[Se1:d:dsp]A2u(a)')
+        self.assertEqual(modes['section'], ['mode definitions'] * 2 + ['strain mode definitions'])
+        self.assertEqual(modes['amplitude'], [0.0, 0.5, 0.0])
+        self.assertEqual(modes['normfactor'][:2], [0.10213, 0.0441])
+
+    def test_ingest(self):
+        items = [(self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis),
+                 (self.topas[1], 'TiSe2_P-3m1.cif', '165', self.basis)]
+        store = isopydistort.modestore.ModeStore(self.path)
+        added, failed = store.ingest(items + items[:1], processes=2)
+        self.assertEqual((len(added), failed), (2, {}))
+        self.assertEqual(store.ingest(items, processes=2), ([], {}))
+        store = isopydistort.modestore.ModeStore(self.path)
+        self.assertEqual(len(store), 6)
+        modes = store.modes('TiSe2_P-3m1.cif', '165', self.basis)
+        self.assertEqual(list(modes['amplitude']), [0.0, 0.5, 0.0])
+        self.assertEqual(modes['name'], ['a1', 'a2', 's1'])
+        rows = store.rows(parentcif='TiSe2_P-3m1.cif')
+        self.assertEqual(store.column('amplitude')[rows].sum(), 1.0)
+        # entries are copies, so editing them leaves the index alone
+        for entry in store.entries().values():
+            entry['start'] = -1
+        self.assertEqual(list(store.rows(subgroup='165')), [3, 4, 5])
+        # the same key from two different files is refused
+        with self.assertRaises(ValueError):
+            store.ingest([items[0], (self.topas[1],) + items[0][1:]])
+
+    def test_update(self):
+        item = (self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis)
+        store = isopydistort.modestore.ModeStore(self.path)
+        store.ingest([item])
+        self.write(self.topas[0], TOPAS_MODES.replace('0.50000', '0.75000'))
+        mtime = os.path.getmtime(self.topas[0]) + 10
+        os.utime(self.topas[0], (mtime, mtime))
+        added, failed = store.ingest([item])
+        self.assertEqual(added, [store.key(*item[1:])])
+        self.assertEqual(len(store), 6)
+        self.assertEqual(list(store.modes(*item[1:])['amplitude']), [0.0, 0.75, 0.0])
+        # compacting drops the superseded block and keeps the live one
+        self.assertEqual(store.compact(), 3)
+        self.assertEqual(len(store), 3)
+        modes = store.modes(*item[1:])
+        self.assertEqual(list(modes['amplitude']), [0.0, 0.75, 0.0])
+        self.assertEqual(modes['label'][2], 'P-3m1[0,0,0]GM1+(a)strain(a)')
+        self.assertEqual(sorted(os.listdir(self.path))[:2], ['amplitude_0.f8', 'amplitude_1.f8'])
+
+    def test_crash_recovery(self):
+        store = isopydistort.modestore.ModeStore(self.path)
+        store.ingest([(self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis)])
+        # leave trailing bytes as an interrupted ingest would
+        for fname in ['amplitude_0.f8', 'name_0.bin', 'name_0.off']:
+            f = open(os.path.join(self.path, fname), 'ab')
+            f.write(b'garbage!')
+            f.close()
+        store.ingest([(self.topas[1], 'TiSe2_P-3m1.cif', '165', self.basis)])
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'amplitude_0.f8')), 6 * 8)
+        self.assertEqual(store.strings('name'), ['a1', 'a2', 's1'] * 2)
+        self.assertEqual(list(store.modes('TiSe2_P-3m1.cif', '165', self.basis)['amplitude']),
+                         [0.0, 0.5, 0.0])
+
+    def test_bad_file(self):
+        bad = self.write('error.txt', '<html>ISODISTORT bombed</html>')
+        store = isopydistort.modestore.ModeStore(self.path)
+        added, failed = store.ingest([(self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis),
+                                      (bad, 'TiSe2_P-3m1.cif', '165', self.basis)])
+        self.assertEqual(len(added), 1)
+        self.assertEqual(list(failed), [bad])
+        self.assertEqual(len(store), 3)
+
+    def test_same_cif_name(self):
+        items = [(self.topas[0], os.path.join('a', 'X.cif'), '1', self.basis),
+                 (self.topas[1], os.path.join('b', 'X.cif'), '1', self.basis)]
+        store = isopydistort.modestore.ModeStore(self.path)
+        self.assertEqual(len(store.ingest(items)[0]), 2)
+        self.assertEqual(store.ingest(items), ([], {}))
+        self.assertEqual(len(store), 6)
+        self.assertEqual(len(store.entries(subgroup='1')), 2)
+
+    def test_readers(self):
+        item = (self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis)
+        writer = isopydistort.modestore.ModeStore(self.path)
+        writer.ingest([item])
+        reader = isopydistort.modestore.ModeStore(self.path)
+        self.write(self.topas[0], TOPAS_MODES.replace('0.50000', '0.75000'))
+        mtime = os.path.getmtime(self.topas[0]) + 10
+        os.utime(self.topas[0], (mtime, mtime))
+        writer.ingest([item])
+        writer.compact()
+        # the reader still sees the generation it opened
+        self.assertEqual(list(reader.modes(*item[1:])['amplitude']), [0.0, 0.5, 0.0])
+        reader.reload()
+        self.assertEqual(list(reader.modes(*item[1:])['amplitude']), [0.0, 0.75, 0.0])
+        # once its files are removed, a reader moves on by itself
+        other = isopydistort.modestore.ModeStore(self.path)
+        writer.compact()
+        writer.compact()
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'amplitude_1.f8')))
+        self.assertEqual(other.modes(*item[1:])['name'], ['a1', 'a2', 's1'])
+
+    def test_lock(self):
+        store = isopydistort.modestore.ModeStore(self.path)
+        with store._lock():
+            with self.assertRaises(RuntimeError):
+                isopydistort.modestore.ModeStore(self.path).compact(timeout=0.2)
+        # a lock file left behind by a dead process does not block
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'ingest.lock')))
+        self.assertEqual(store.compact(timeout=0.2), 0)
+
+    def test_working_directory(self):
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(self.tmp.name)
+        store = isopydistort.modestore.ModeStore(self.path, root=self.tmp.name)
+        store.ingest([('TiSe2_iso_0.txt', 'TiSe2_P-3m1.cif', '1', self.basis)])
+        os.chdir(self.path)
+        store = isopydistort.modestore.ModeStore(self.path, root='..')
+        self.assertEqual(store.modes('TiSe2_P-3m1.cif', '1', self.basis)['name'],
+                         ['a1', 'a2', 's1'])
+        self.assertEqual(store.ingest([(self.topas[0], 'TiSe2_P-3m1.cif', '1', self.basis)]),
+                         ([], {}))
+
+    def test_basis(self):
+        store = isopydistort.modestore.ModeStore(self.path)
+        key = store.key('X.cif', '1', [[0.5, 0, 0], [0, 1, 0], [0, 0, 1]])
+        self.assertEqual(store.key('X.cif', '1', ['1/2', '-0.0', 0, 0, 1, 0, 0, 0, '1']), key)
+        self.assertEqual(store.key('X.cif', '1', {'basis11': '1/2'}), key)
+
+# End of class
+
 if __name__ == '__main__':
     unittest.main()
 
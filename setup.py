@@ -28,6 +28,7 @@ setup_args = dict(
         version = '0.1',
         namespace_packages = [],
         packages = find_packages(),
+        install_requires = ['requests', 'numpy'],
         test_suite = 'isopydistort.tests',
         include_package_data = True,
         zip_safe = False,